@@ -1,24 +1,386 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-import requests
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+import asyncio
+import contextlib
+import hashlib
+import httpx
+import diskcache
+import numpy as np
 import os
-import json
-import re
-import base64
+import orjson
+import re2
+import binascii
 import io
-from PIL import Image, ImageDraw, ImageFilter
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import cv2
 import random
+import ahocorasick
+
+# Numba caches compiled kernels on disk; /tmp is the only writable path on Vercel
+os.environ.setdefault('NUMBA_CACHE_DIR', '/tmp/numba')
+from numba import njit
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, for request parsing and jsonify alike"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)  # Enable CORS for all routes
 
+
+class ConcurrentWsgiToAsgi(WsgiToAsgi):
+    """Serve the Flask app over ASGI, with async views running on the server's event loop"""
+
+    def __init__(self, wsgi_application, max_requests):
+        super().__init__(wsgi_application)
+        self.max_requests = max_requests
+        self.request_slots = None
+        self.loop = None
+
+    def serves_running_loop(self):
+        """Whether the current coroutine runs on the long-lived server loop"""
+        return self.loop is not None and asyncio.get_running_loop() is self.loop
+
+    async def __call__(self, scope, receive, send):
+        if self.request_slots is None:
+            self.loop = asyncio.get_running_loop()
+            self.request_slots = asyncio.Semaphore(self.max_requests)
+
+        # Every in-flight request holds one thread while its view runs, so the slots
+        # bound the threads per worker; excess requests queue on the loop instead
+        async with self.request_slots:
+            # WsgiToAsgi runs the app thread-sensitively, which by default means one shared
+            # thread for every request; a ThreadSensitiveContext gives each request its own
+            async with ThreadSensitiveContext():
+                await super().__call__(scope, receive, send)
+
+
+# ASGI entrypoint, run with `uvicorn app:asgi_app` (see gunicorn.conf.py for production)
+asgi_app = ConcurrentWsgiToAsgi(app, max_requests=int(os.environ.get('MAX_CONCURRENT_REQUESTS', '1000')))
+
 # Gemini API configuration - Using Vercel environment variable
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
-GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent?key={GEMINI_API_KEY}"
+GEMINI_MODEL = "models/gemini-1.5-flash"
+GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/{GEMINI_MODEL}:generateContent?key={GEMINI_API_KEY}"
+GEMINI_STREAM_URL = f"https://generativelanguage.googleapis.com/v1beta/{GEMINI_MODEL}:streamGenerateContent?alt=sse&key={GEMINI_API_KEY}"
+GEMINI_EMBED_MODEL = "models/text-embedding-004"
+GEMINI_BATCH_EMBED_URL = f"https://generativelanguage.googleapis.com/v1beta/{GEMINI_EMBED_MODEL}:batchEmbedContents?key={GEMINI_API_KEY}"
+
+# Under uvicorn every async view runs on the server's loop, so all requests share one
+# pooled HTTP/2 client. The WSGI path (dev server, Vercel) gives each request a throwaway
+# loop, and an AsyncClient cannot outlive its loop, so there each call gets its own.
+_server_client = None
+GEMINI_POOL_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+# Set once on each client; request bodies are pre-serialized with orjson
+GEMINI_HEADERS = {'Content-Type': 'application/json'}
+
+
+def new_gemini_client():
+    """Create an HTTP client for Gemini calls"""
+    # Keep-alive pool sized for bursts, retrying connection failures twice
+    transport = httpx.AsyncHTTPTransport(http2=True, retries=2, limits=GEMINI_POOL_LIMITS)
+    return httpx.AsyncClient(transport=transport, headers=GEMINI_HEADERS, timeout=30)
+
+
+@contextlib.asynccontextmanager
+async def gemini_client():
+    """Yield the shared server client, or a one-off client closed after the call"""
+    global _server_client
+    if asgi_app.serves_running_loop():
+        if _server_client is None:
+            _server_client = new_gemini_client()
+        yield _server_client
+    else:
+        async with new_gemini_client() as client:
+            yield client
+
+
+async def call_gemini(prompt):
+    """Send a prompt to Gemini and return the text of the first candidate"""
+    async with gemini_client() as client:
+        response = await client.post(GEMINI_API_URL, content=orjson.dumps(prompt))
+
+    if response.status_code != 200:
+        raise Exception(f"API error: {response.status_code}")
+
+    response_data = orjson.loads(response.content)
+    return response_data['candidates'][0]['content']['parts'][0]['text']
+
+
+# Streaming goes through a sync client: Flask can only stream from a sync generator.
+# httpx.Client is thread-safe, so one pool serves every worker thread.
+gemini_stream_client = httpx.Client(http2=True, headers=GEMINI_HEADERS, timeout=30, limits=GEMINI_POOL_LIMITS)
+
+
+def stream_gemini(prompt):
+    """Yield text deltas from Gemini's server-sent event stream as they arrive"""
+    with gemini_stream_client.stream("POST", GEMINI_STREAM_URL, content=orjson.dumps(prompt)) as response:
+        if response.status_code != 200:
+            raise Exception(f"API error: {response.status_code}")
+
+        for line in response.iter_lines():
+            if not line.startswith('data:'):
+                continue
+            chunk = orjson.loads(line[len('data:'):])
+            for part in chunk['candidates'][0]['content'].get('parts', []):
+                if part.get('text'):
+                    yield part['text']
+
+
+# Persistent cache of Gemini replies (/tmp is the only writable path on Vercel)
+gemini_cache = diskcache.Cache('/tmp/gemini')
+GEMINI_CACHE_TTL = 7 * 24 * 60 * 60  # 7 days, so stale answers eventually refresh
+
+
+def gemini_cache_key(*parts):
+    """Hash the inputs that fully determine a prompt into a compact cache key"""
+    return hashlib.blake2b('\x1f'.join(parts).encode(), digest_size=16).hexdigest()
+
+
+async def cached_gemini(prompt, key, parse, use_cache=True):
+    """Call Gemini, serving repeat prompts from the on-disk cache.
+
+    The reply is stored as parse(text), and only when parsing succeeds, so one
+    malformed reply is not served from the cache for the whole TTL. Returns None
+    when the reply does not parse.
+    """
+    # diskcache reads and writes are blocking sqlite and pickle work, so keep them off the event loop
+    if use_cache:
+        cached = await asyncio.to_thread(gemini_cache.get, key)
+        if cached is not None:
+            return cached
+
+    parsed = parse(await call_gemini(prompt))
+    if parsed is not None:
+        await asyncio.to_thread(gemini_cache.set, key, parsed, expire=GEMINI_CACHE_TTL)
+    return parsed
+
+
+def cache_enabled():
+    """Allow clients to bypass the Gemini cache with ?no_cache=1"""
+    return request.args.get('no_cache') != '1'
+
+
+# Semantic cache for analyses: answer sets rarely match byte-for-byte, but close ones
+# produce near-identical analyses, so reuse any stored analysis above this similarity
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_TTL = 24 * 60 * 60  # 24 hours
+SEMANTIC_CACHE_MAX_ENTRIES = 256  # per life area
+
+
+# Concurrent embedding requests on the server loop are coalesced into one
+# batchEmbedContents call: the first request in a window waits briefly for others
+EMBED_BATCH_WINDOW = 0.025  # seconds
+EMBED_BATCH_SIZE = 16
+EMBED_MAX_INFLIGHT = 8  # concurrent batchEmbedContents calls per worker
+EMBED_QUEUE_SIZE = EMBED_BATCH_SIZE * EMBED_MAX_INFLIGHT  # queued texts before callers wait
+_embed_batcher = None
+
+
+async def batch_embed(texts):
+    """Embed several texts in a single Gemini call, returning unit-length vectors"""
+    prompt = {"requests": [
+        {"model": GEMINI_EMBED_MODEL, "content": {"parts": [{"text": text}]}}
+        for text in texts
+    ]}
+    async with gemini_client() as client:
+        response = await client.post(GEMINI_BATCH_EMBED_URL, content=orjson.dumps(prompt))
+
+    if response.status_code != 200:
+        raise Exception(f"Embedding API error: {response.status_code}")
+
+    embeddings = orjson.loads(response.content)['embeddings']
+    vectors = np.asarray([e['values'] for e in embeddings], dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+async def run_embed_batcher(queue):
+    """Drain queued (text, future) pairs in small windows, one API call per batch"""
+    # Batches are dispatched as tasks so up to EMBED_MAX_INFLIGHT calls overlap; past
+    # that the bounded queue fills and embed_text callers wait for room
+    slots = asyncio.Semaphore(EMBED_MAX_INFLIGHT)
+    in_flight = set()
+    while True:
+        batch = [await queue.get()]
+        await asyncio.sleep(EMBED_BATCH_WINDOW)
+        await slots.acquire()
+        while len(batch) < EMBED_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        # Keep a reference to each task so it is not garbage collected mid-flight
+        task = asyncio.create_task(resolve_embed_batch(batch, slots))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+
+async def resolve_embed_batch(batch, slots):
+    """Embed one drained batch and settle each caller's future"""
+    try:
+        vectors = await batch_embed([text for text, _ in batch])
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+    else:
+        for (_, future), vector in zip(batch, vectors):
+            if not future.done():
+                future.set_result(vector)
+    finally:
+        slots.release()
+
+
+async def embed_text(text):
+    """Embed text with Gemini and return it as a unit-length vector"""
+    global _embed_batcher
+    if not asgi_app.serves_running_loop():
+        # A per-request loop never sees another request to batch with
+        return (await batch_embed([text]))[0]
+
+    if _embed_batcher is None:
+        queue = asyncio.Queue(maxsize=EMBED_QUEUE_SIZE)
+        # Keep a reference to the task so it is not garbage collected mid-flight
+        _embed_batcher = (queue, asyncio.get_running_loop().create_task(run_embed_batcher(queue)))
+
+    future = asyncio.get_running_loop().create_future()
+    await _embed_batcher[0].put((text, future))
+    return await future
+
+
+def canonical_responses(life_area, responses, questions_data):
+    """Order-independent text form of an answer set, used as the semantic cache key"""
+    pairs = []
+    for key, value in responses.items():
+        if key.startswith('question'):
+            q_index = int(key[8:])  # strip the 'question' prefix
+            if q_index < len(questions_data):
+                # Embed the chosen option's text; the bare index "1"-"5" says nothing about the answer
+                pairs.append(f"{questions_data[q_index]['question']}|{value.get('answerText', value['answer'])}")
+    return f"{life_area}\n" + "\n".join(sorted(pairs))
+
+
+def semantic_cache_key(life_area):
+    """Cache key holding the embedding list for one life area"""
+    return gemini_cache_key("analysis_semantic_v4", life_area)
+
+
+def semantic_cache_lookup(life_area, vector):
+    """Return the cached analysis most similar to vector, if it clears the threshold"""
+    entries = gemini_cache.get(semantic_cache_key(life_area), [])
+    now = time.time()
+    entries = [entry for entry in entries if now - entry[2] < SEMANTIC_CACHE_TTL]
+    if not entries:
+        return None
+
+    scores = np.stack([entry[0] for entry in entries]) @ vector
+    best = int(np.argmax(scores))
+    if scores[best] > SEMANTIC_CACHE_THRESHOLD:
+        return entries[best][1]
+    return None
+
+
+def semantic_cache_store(life_area, vector, analysis):
+    """Remember an analysis under its embedding, namespaced by life area"""
+    key = semantic_cache_key(life_area)
+    # Read-modify-write of the entry list; transact keeps concurrent writers from dropping entries
+    with gemini_cache.transact():
+        now = time.time()
+        entries = [entry for entry in gemini_cache.get(key, []) if now - entry[2] < SEMANTIC_CACHE_TTL]
+        entries.append((vector, analysis, now))
+        gemini_cache.set(key, entries[-SEMANTIC_CACHE_MAX_ENTRIES:], expire=SEMANTIC_CACHE_TTL)
+
+
+async def semantic_cached_gemini(prompt, life_area, canonical_text, use_cache=True):
+    """Call Gemini unless a semantically similar analysis is already cached"""
+    try:
+        vector = await embed_text(canonical_text)
+    except Exception as e:
+        # The cache is an optimization only; never let it fail the analysis
+        print(f"Error embedding responses: {e}")
+        return await call_gemini(prompt)
+
+    if use_cache:
+        # Cache reads and writes hit disk and unpickle the entry list, so keep them off the event loop
+        try:
+            cached = await asyncio.to_thread(semantic_cache_lookup, life_area, vector)
+        except Exception as e:
+            print(f"Error reading semantic cache: {e}")
+            cached = None
+        if cached is not None:
+            return cached
+
+    analysis = await call_gemini(prompt)
+    try:
+        await asyncio.to_thread(semantic_cache_store, life_area, vector, analysis)
+    except Exception as e:
+        print(f"Error writing semantic cache: {e}")
+    return analysis
+
+
+# Fixed instructions go in Gemini's system instruction; the per-request user turn
+# carries only the life area and answers, keeping the shared prompt prefix identical
+QUESTIONS_INSTRUCTION = """
+As an emotional wellness AI, generate exactly 5 questions to help someone analyze the life area they name.
+For EACH question, also provide 5 appropriate answer options that make sense for that specific question.
+
+Return the questions and options as a JSON array with this exact format:
+[
+  {
+    "question": "Question text here",
+    "options": ["Option 1", "Option 2", "Option 3", "Option 4", "Option 5"]
+  },
+  // ... repeat for 5 questions
+]
+
+Make sure the answer options are relevant to each specific question.
+For example, if the question is about frequency, options could be about time periods.
+If the question is about intensity, options could be about strength of feeling.
+"""
+
+ANALYSIS_INSTRUCTION = """
+You will receive someone's responses about an area of their life. Provide a comprehensive emotional analysis.
+
+Please provide a personalized analysis that:
+1. Summarizes their emotional state specifically based on their answers
+2. Identifies 3 key challenges or blockers they're facing
+3. Notes any signs of emotional fatigue or burnout
+4. Provides 4-5 actionable suggestions tailored to their specific responses
+
+Make the analysis personal and specific to their answers, not generic.
+Format your response in HTML with headings (h4 for section titles) and paragraphs/lists.
+Do not include any introductory or concluding text - just the analysis.
+"""
+
+
+# Request fragments that never change, built once and shared by every request
+QUESTIONS_SYSTEM_INSTRUCTION = {"parts": [{"text": QUESTIONS_INSTRUCTION}]}
+ANALYSIS_SYSTEM_INSTRUCTION = {"parts": [{"text": ANALYSIS_INSTRUCTION}]}
+
+
+def gemini_prompt(system_instruction, text):
+    """Build a generateContent request from a prebuilt system instruction and a user turn"""
+    return {
+        "systemInstruction": system_instruction,
+        "contents": [{"role": "user", "parts": [{"text": text}]}]
+    }
+
 
 # Generate questions with appropriate answer options based on life area
 @app.route('/api/generate-questions', methods=['POST'])
-def generate_questions():
+async def generate_questions():
     try:
         data = request.get_json()
         life_area = data.get('lifeArea', 'general life')
@@ -27,39 +389,13 @@ def generate_questions():
         if not GEMINI_API_KEY:
             return jsonify({"questions": get_fallback_questions(life_area)})
 
-        prompt = {
-            "contents": [{
-                "parts": [{
-                    "text": f"""
-                    As an emotional wellness AI, generate exactly 5 questions to help someone analyze their {life_area}.
-                    For EACH question, also provide 5 appropriate answer options that make sense for that specific question.
-
-                    Return the questions and options as a JSON array with this exact format:
-                    [
-                      {{
-                        "question": "Question text here",
-                        "options": ["Option 1", "Option 2", "Option 3", "Option 4", "Option 5"]
-                      }},
-                      // ... repeat for 5 questions
-                    ]
-
-                    Make sure the answer options are relevant to each specific question.
-                    For example, if the question is about frequency, options could be about time periods.
-                    If the question is about intensity, options could be about strength of feeling.
-                    """
-                }]
-            }]
-        }
+        prompt = gemini_prompt(QUESTIONS_SYSTEM_INSTRUCTION, f"Life area: {life_area}")
 
-        headers = {'Content-Type': 'application/json'}
-        response = requests.post(GEMINI_API_URL, headers=headers, json=prompt)
-
-        if response.status_code == 200:
-            response_data = response.json()
-            questions_text = response_data['candidates'][0]['content']['parts'][0]['text']
-            questions_data = parse_questions_with_options(questions_text)
-        else:
-            raise Exception(f"API error: {response.status_code}")
+        # The prompt template is fixed, so the life area alone determines the reply
+        cache_key = gemini_cache_key("questions_v3", life_area)
+        questions_data = await cached_gemini(prompt, cache_key, extract_questions, use_cache=cache_enabled())
+        if questions_data is None:
+            questions_data = get_fallback_questions(life_area)
 
         return jsonify({"questions": questions_data})
 
@@ -68,9 +404,33 @@ def generate_questions():
         return jsonify({"questions": get_fallback_questions(life_area)})
 
 
+def analysis_prompt(life_area, responses, questions_data):
+    """Build the Gemini prompt asking for an HTML analysis of the responses"""
+    # Format responses for the prompt
+    parts = []
+    for key, value in responses.items():
+        if key.startswith('question'):
+            q_index = int(key[8:])  # strip the 'question' prefix
+            if q_index < len(questions_data):
+                question_text = questions_data[q_index]['question']
+                parts.append(f"Q: {question_text}\nA: {value['answer']}\n")
+    response_text = "QUESTIONS AND ANSWERS:\n\n" + "\n".join(parts)
+
+    prompt = gemini_prompt(ANALYSIS_SYSTEM_INSTRUCTION, f"Life area: {life_area}\n\n{response_text}")
+
+    return prompt
+
+
+async def build_analysis(life_area, responses, questions_data, use_cache=True):
+    """Ask Gemini (through the semantic cache) for an HTML analysis of the responses"""
+    prompt = analysis_prompt(life_area, responses, questions_data)
+    canonical_text = canonical_responses(life_area, responses, questions_data)
+    return await semantic_cached_gemini(prompt, life_area, canonical_text, use_cache=use_cache)
+
+
 # Generate analysis based on responses
 @app.route('/api/generate-analysis', methods=['POST'])
-def generate_analysis():
+async def generate_analysis():
     try:
         data = request.get_json()
         life_area = data.get('lifeArea', 'general life')
@@ -81,45 +441,7 @@ def generate_analysis():
         if not GEMINI_API_KEY:
             return jsonify({"analysis": get_fallback_analysis(life_area, responses, questions_data)})
 
-        # Format responses for the prompt
-        response_text = "QUESTIONS AND ANSWERS:\n\n"
-        for key, value in responses.items():
-            if key.startswith('question'):
-                q_index = int(key.replace('question', ''))
-                if q_index < len(questions_data):
-                    question_text = questions_data[q_index]['question']
-                    response_text += f"Q: {question_text}\nA: {value['answer']}\n\n"
-
-        prompt = {
-            "contents": [{
-                "parts": [{
-                    "text": f"""
-                    Based on the following responses about {life_area}, provide a comprehensive emotional analysis:
-
-                    {response_text}
-
-                    Please provide a personalized analysis that:
-                    1. Summarizes their emotional state specifically based on their answers
-                    2. Identifies 3 key challenges or blockers they're facing
-                    3. Notes any signs of emotional fatigue or burnout
-                    4. Provides 4-5 actionable suggestions tailored to their specific responses
-
-                    Make the analysis personal and specific to their answers, not generic.
-                    Format your response in HTML with headings (h4 for section titles) and paragraphs/lists.
-                    Do not include any introductory or concluding text - just the analysis.
-                    """
-                }]
-            }]
-        }
-
-        headers = {'Content-Type': 'application/json'}
-        response = requests.post(GEMINI_API_URL, headers=headers, json=prompt)
-
-        if response.status_code == 200:
-            response_data = response.json()
-            analysis = response_data['candidates'][0]['content']['parts'][0]['text']
-        else:
-            raise Exception(f"API error: {response.status_code}")
+        analysis = await build_analysis(life_area, responses, questions_data, use_cache=cache_enabled())
 
         return jsonify({"analysis": analysis})
 
@@ -128,32 +450,114 @@ def generate_analysis():
         return jsonify({"analysis": get_fallback_analysis(life_area, responses, questions_data)})
 
 
+async def visualize_analysis(analysis, life_area):
+    """Render the visualization for an analysis, falling back to a stock abstract image"""
+    # Render off the event loop so other requests keep flowing while the image is drawn
+    loop = asyncio.get_running_loop()
+    try:
+        emotional_cues = extract_emotional_cues(analysis)
+        image_data = await loop.run_in_executor(IMG_POOL, generate_abstract_visualization, emotional_cues)
+        description = f"Abstract visualization of your emotional state regarding {life_area}"
+    except Exception as e:
+        print(f"Error generating emotion image: {e}")
+        image_data = random.choice(await loop.run_in_executor(IMG_POOL, fallback_pool))
+        description = "Abstract representation of emotional state"
+    return {"imageData": image_data, "description": description}
+
+
 # Generate emotional visualization image
 @app.route('/api/generate-emotion-image', methods=['POST'])
-def generate_emotion_image():
-    try:
-        data = request.get_json()
-        analysis = data.get('analysis', '')
-        life_area = data.get('lifeArea', 'general life')
+async def generate_emotion_image():
+    data = request.get_json()
+    analysis = data.get('analysis', '')
+    life_area = data.get('lifeArea', 'general life')
 
-        # Extract emotional cues from the analysis
-        emotional_cues = extract_emotional_cues(analysis)
+    return jsonify(await visualize_analysis(analysis, life_area))
 
-        # Generate an abstract image based on emotional cues
-        image_data = generate_abstract_visualization(emotional_cues)
 
-        return jsonify({
-            "imageData": image_data,
-            "description": f"Abstract visualization of your emotional state regarding {life_area}"
-        })
+# Generate the analysis and its visualization in a single round-trip
+@app.route('/api/analyze-and-visualize', methods=['POST'])
+async def analyze_and_visualize():
+    data = request.get_json()
+    life_area = data.get('lifeArea', 'general life')
+    responses = data.get('responses', {})
+    questions_data = data.get('questionsData', [])
 
+    try:
+        if not GEMINI_API_KEY:
+            analysis = get_fallback_analysis(life_area, responses, questions_data)
+        else:
+            analysis = await build_analysis(life_area, responses, questions_data, use_cache=cache_enabled())
     except Exception as e:
-        print(f"Error generating emotion image: {e}")
-        # Return a fallback abstract image
-        return jsonify({
-            "imageData": generate_fallback_image(),
-            "description": "Abstract representation of emotional state"
-        })
+        print(f"Error generating analysis: {e}")
+        analysis = get_fallback_analysis(life_area, responses, questions_data)
+
+    return jsonify({"analysis": analysis, **await visualize_analysis(analysis, life_area)})
+
+
+def sse_event(event, payload):
+    """Format one server-sent event with a JSON payload"""
+    return f"event: {event}\ndata: {app.json.dumps(payload)}\n\n"
+
+
+# Stream the analysis as Gemini generates it, followed by its visualization.
+# Events: `delta` appends text, `analysis` replaces the whole text, `image` ends the stream.
+@app.route('/api/generate-analysis-stream', methods=['POST'])
+def generate_analysis_stream():
+    data = request.get_json()
+    life_area = data.get('lifeArea', 'general life')
+    responses = data.get('responses', {})
+    questions_data = data.get('questionsData', [])
+    use_cache = cache_enabled()
+
+    def events():
+        analysis = None
+        if GEMINI_API_KEY:
+            vector = None
+            try:
+                canonical_text = canonical_responses(life_area, responses, questions_data)
+                vector = app.ensure_sync(embed_text)(canonical_text)
+                if use_cache:
+                    analysis = semantic_cache_lookup(life_area, vector)
+                    if analysis is not None:
+                        yield sse_event('analysis', {"text": analysis})
+            except Exception as e:
+                print(f"Error embedding responses: {e}")
+
+            if analysis is None:
+                try:
+                    parts = []
+                    for delta in stream_gemini(analysis_prompt(life_area, responses, questions_data)):
+                        parts.append(delta)
+                        yield sse_event('delta', {"text": delta})
+                    # An empty stream is a failed generation: don't cache it, use the fallback
+                    analysis = "".join(parts) or None
+                except Exception as e:
+                    print(f"Error streaming analysis: {e}")
+                    analysis = None
+
+                # The client already holds the streamed text, so a failed write must not replace it
+                if analysis is not None and vector is not None:
+                    try:
+                        semantic_cache_store(life_area, vector, analysis)
+                    except Exception as e:
+                        print(f"Error writing semantic cache: {e}")
+
+        if analysis is None:
+            analysis = get_fallback_analysis(life_area, responses, questions_data)
+            yield sse_event('analysis', {"text": analysis})
+
+        try:
+            image_data = generate_abstract_visualization(extract_emotional_cues(analysis))
+            description = f"Abstract visualization of your emotional state regarding {life_area}"
+        except Exception as e:
+            print(f"Error generating emotion image: {e}")
+            image_data = random.choice(fallback_pool())
+            description = "Abstract representation of emotional state"
+        yield sse_event('image', {"imageData": image_data, "description": description})
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 def get_fallback_questions(life_area):
@@ -232,28 +636,59 @@ def get_fallback_analysis(life_area, responses, questions_data):
     """
 
 
-def parse_questions_with_options(text):
-    """Parse the response from Gemini to extract questions with options"""
+# Markdown code fences Gemini sometimes wraps around JSON replies
+CODE_FENCE_PATTERN = re2.compile(r'```json\s*|\s*```')
+
+
+def valid_questions(questions_data):
+    """Return the first five questions if the parsed reply has the expected shape, else None"""
+    if (isinstance(questions_data, list) and
+            len(questions_data) >= 5 and
+            all(isinstance(q, dict) and 'question' in q and 'options' in q for q in questions_data)):
+        return questions_data[:5]
+    return None
+
+
+def extract_questions(text):
+    """Extract validated questions with options from a Gemini reply, or None"""
+    try:
+        # Gemini usually returns bare JSON, so try it as-is before any cleanup
+        questions = valid_questions(orjson.loads(text))
+        if questions is not None:
+            return questions
+    except orjson.JSONDecodeError:
+        pass
+
+    # Otherwise (prose, code fences, or JSON of the wrong shape) find the JSON array in the response
     try:
-        # Try to find JSON array in the response
         start = text.find('[')
         end = text.rfind(']') + 1
-        if start != -1 and end != -1:
+        if start != -1 and end != 0:
             json_str = text[start:end]
             # Clean up any markdown code formatting
-            json_str = re.sub(r'```json\s*|\s*```', '', json_str)
-            questions_data = json.loads(json_str)
-
-            # Validate structure
-            if (isinstance(questions_data, list) and
-                    len(questions_data) >= 5 and
-                    all('question' in q and 'options' in q for q in questions_data)):
-                return questions_data[:5]
+            json_str = CODE_FENCE_PATTERN.sub('', json_str)
+            return valid_questions(orjson.loads(json_str))
     except Exception as e:
         print(f"Error parsing JSON: {e}")
+    return None
+
 
-    # Fallback if parsing fails
-    return get_fallback_questions("selected area")
+# Terms that signal each emotional tone, matched as substrings so stems like
+# 'excite' and 'improve' also catch 'excited' and 'improvement'
+EMOTION_TERMS = {
+    'positive': ['positive', 'happy', 'joy', 'content', 'satisfied', 'growth', 'improve', 'good', 'well', 'better'],
+    'negative': ['negative', 'sad', 'challenge', 'difficult', 'blocker', 'fatigue', 'stress', 'anxious',
+                 'overwhelm', 'hard'],
+    'energetic': ['energy', 'active', 'dynamic', 'vibrant', 'excite', 'motivate', 'drive'],
+    'calm': ['calm', 'peace', 'serene', 'tranquil', 'relax', 'balance', 'centered'],
+}
+TERM_TO_CAT = {term: category for category, terms in EMOTION_TERMS.items() for term in terms}
+
+# One automaton matches every term in a single pass over the text
+EMOTION_AUTOMATON = ahocorasick.Automaton()
+for _term, _category in TERM_TO_CAT.items():
+    EMOTION_AUTOMATON.add_word(_term, _category)
+EMOTION_AUTOMATON.make_automaton()
 
 
 def extract_emotional_cues(analysis):
@@ -267,33 +702,9 @@ def extract_emotional_cues(analysis):
         'focused': 0
     }
 
-    # Simple text analysis to detect emotional tones
-    text = analysis.lower()
-
-    # Positive emotions
-    positive_terms = ['positive', 'happy', 'joy', 'content', 'satisfied', 'growth', 'improve', 'good', 'well', 'better']
-    for term in positive_terms:
-        if term in text:
-            emotional_cues['positive'] += text.count(term)
-
-    # Negative emotions
-    negative_terms = ['negative', 'sad', 'challenge', 'difficult', 'blocker', 'fatigue', 'stress', 'anxious',
-                      'overwhelm', 'hard']
-    for term in negative_terms:
-        if term in text:
-            emotional_cues['negative'] += text.count(term)
-
-    # Energetic emotions
-    energetic_terms = ['energy', 'active', 'dynamic', 'vibrant', 'excite', 'motivate', 'drive']
-    for term in energetic_terms:
-        if term in text:
-            emotional_cues['energetic'] += text.count(term)
-
-    # Calm emotions
-    calm_terms = ['calm', 'peace', 'serene', 'tranquil', 'relax', 'balance', 'centered']
-    for term in calm_terms:
-        if term in text:
-            emotional_cues['calm'] += text.count(term)
+    # Single pass over the text for all terms at once
+    for _, category in EMOTION_AUTOMATON.iter(analysis.lower()):
+        emotional_cues[category] += 1
 
     # Normalize values
     total = sum(emotional_cues.values())
@@ -304,28 +715,63 @@ def extract_emotional_cues(analysis):
     return emotional_cues
 
 
+# Shared pool for CPU-bound rendering. Threads rather than processes: the Numba
+# kernels run without the GIL and OpenCV/zlib release it, the render LRU stays
+# shared, and serverless runtimes often lack the shared memory multiprocessing needs
+IMG_POOL = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='render')
+
+CUE_NAMES = ('positive', 'negative', 'energetic', 'calm', 'chaotic', 'focused')
+# Threshold decisions are made on the exact cues and packed alongside the levels,
+# so quantization never moves a cue across one: (switch, cue, threshold)
+CUE_SWITCHES = (
+    ('chaos_shapes', 'chaotic', 0.3),
+    ('focused_shapes', 'focused', 0.3),
+    ('blur', 'chaotic', 0.4),
+    ('smooth', 'calm', 0.6),
+)
+
+
 def generate_abstract_visualization(emotional_cues):
     """Generate an abstract image based on emotional cues"""
-    # Create a color palette based on emotions
+    # Near-identical emotional profiles share one rendered image: each cue is
+    # quantized to 16 levels and the six 4-bit levels are packed into one int,
+    # followed by one bit per threshold switch
+    cue_key = 0
+    for i, name in enumerate(CUE_NAMES):
+        cue_key |= min(15, int(emotional_cues[name] * 16)) << (4 * i)
+    for i, (_, name, threshold) in enumerate(CUE_SWITCHES):
+        cue_key |= (emotional_cues[name] > threshold) << (4 * len(CUE_NAMES) + i)
+    return render_visualization(cue_key)
+
+
+@functools.lru_cache(maxsize=1024)
+def render_visualization(cue_key):
+    """Render the visualization for a packed, quantized emotional profile"""
+    # Decode each level to the middle of its bucket (level 0 stays 0), so colors
+    # are not biased dark by rounding every cue down
+    levels = {name: (cue_key >> (4 * i)) & 0xF for i, name in enumerate(CUE_NAMES)}
+    emotional_cues = {name: (level + 0.5) / 16 if level else 0.0 for name, level in levels.items()}
+    switches = {switch: bool(cue_key >> (4 * len(CUE_NAMES) + i) & 1)
+                for i, (switch, _, _) in enumerate(CUE_SWITCHES)}
+
+    # Seeding from the key makes each image a pure function of its profile
+    rng = np.random.default_rng(cue_key)
+
+    # Shapes are rasterized straight into a pixel buffer, then handed to PIL once
     width, height = 400, 400
-    image = Image.new('RGB', (width, height), (0, 0, 0))
-    draw = ImageDraw.Draw(image)
+    pixels = np.zeros((height, width, 3), dtype=np.uint8)
 
     # Determine base colors based on emotional cues
     base_color = calculate_base_color(emotional_cues)
 
     # Draw abstract shapes based on emotions
-    draw_emotional_shapes(draw, width, height, emotional_cues, base_color)
+    draw_emotional_shapes(pixels, emotional_cues, switches, base_color, rng)
 
     # Apply filters based on emotional intensity
-    apply_emotional_filters(image, emotional_cues)
-
-    # Convert to base64
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
+    pixels = apply_emotional_filters(pixels, switches)
+    image = Image.fromarray(pixels, 'RGB')
 
-    return f"data:image/png;base64,{img_str}"
+    return encode_png(image)
 
 
 def calculate_base_color(emotional_cues):
@@ -348,86 +794,206 @@ def calculate_base_color(emotional_cues):
     return (r, g, b)
 
 
-def draw_emotional_shapes(draw, width, height, emotional_cues, base_color):
+SHAPE_CIRCLE, SHAPE_RECTANGLE, SHAPE_POLYGON, SHAPE_CHAOS, SHAPE_FOCUSED = range(5)
+_rng = np.random.default_rng()
+
+
+def draw_emotional_shapes(pixels, emotional_cues, switches, base_color, rng):
     """Draw abstract shapes based on emotional cues"""
+    height, width = pixels.shape[:2]
+
     # Number of shapes based on energy level
     num_shapes = int(10 + 40 * emotional_cues['energetic'])
 
-    for _ in range(num_shapes):
-        # Shape type based on emotional cues
-        if emotional_cues['chaotic'] > 0.3:
-            shape_type = 'chaos'
-        elif emotional_cues['focused'] > 0.3:
-            shape_type = 'focused'
-        else:
-            shape_type = random.choice(['circle', 'rectangle', 'polygon'])
-
-        # Position and size
-        x = random.randint(0, width)
-        y = random.randint(0, height)
-        size = random.randint(10, 100)
-
-        # Color variation from base color
-        color_variation = 50
-        r = min(255, max(0, base_color[0] + random.randint(-color_variation, color_variation)))
-        g = min(255, max(0, base_color[1] + random.randint(-color_variation, color_variation)))
-        b = min(255, max(0, base_color[2] + random.randint(-color_variation, color_variation)))
-        color = (r, g, b, random.randint(100, 200))  # Add alpha
-
-        # Draw shape
-        if shape_type == 'circle':
-            draw.ellipse([x, y, x + size, y + size], fill=color)
-        elif shape_type == 'rectangle':
-            draw.rectangle([x, y, x + size, y + size], fill=color)
-        elif shape_type == 'polygon':
-            points = [(x, y), (x + size, y), (x + size // 2, y + size)]
-            draw.polygon(points, fill=color)
-        elif shape_type == 'chaos':
+    # Shape type based on emotional cues
+    if switches['chaos_shapes']:
+        kinds = np.full(num_shapes, SHAPE_CHAOS)
+    elif switches['focused_shapes']:
+        kinds = np.full(num_shapes, SHAPE_FOCUSED)
+    else:
+        kinds = rng.integers(SHAPE_CIRCLE, SHAPE_POLYGON, num_shapes, endpoint=True)
+
+    # Position and size, drawn for every shape up front
+    xs = rng.integers(0, width, num_shapes, endpoint=True)
+    ys = rng.integers(0, height, num_shapes, endpoint=True)
+    sizes = rng.integers(10, 100, num_shapes, endpoint=True)
+
+    # Color variation from base color
+    color_variation = 50
+    variations = rng.integers(-color_variation, color_variation, (num_shapes, 3), endpoint=True)
+    colors = np.clip(np.asarray(base_color) + variations, 0, 255).astype(np.uint8)
+
+    # Chaotic shapes are bursts of 5 lines, each with its own end point and width
+    line_offsets = rng.integers(-50, 50, (num_shapes, 5, 2), endpoint=True)
+    line_widths = rng.integers(1, 5, (num_shapes, 5), endpoint=True)
+
+    render_shapes(pixels, kinds, xs, ys, sizes, colors, line_offsets, line_widths)
+
+
+@njit(cache=True, nogil=True)
+def render_shapes(pixels, kinds, xs, ys, sizes, colors, line_offsets, line_widths):
+    """Rasterize every shape into the pixel buffer in one compiled loop"""
+    for i in range(kinds.shape[0]):
+        x, y, size, color = xs[i], ys[i], sizes[i], colors[i]
+        kind = kinds[i]
+        if kind == SHAPE_CIRCLE:
+            _fill_ellipse(pixels, x, y, x + size, y + size, color)
+        elif kind == SHAPE_RECTANGLE:
+            _fill_rectangle(pixels, x, y, x + size, y + size, color)
+        elif kind == SHAPE_POLYGON:
+            _fill_triangle(pixels, x, y, x + size, y, x + size // 2, y + size, color)
+        elif kind == SHAPE_CHAOS:
             # Chaotic lines
-            for i in range(5):
-                draw.line([(x, y), (x + random.randint(-50, 50), y + random.randint(-50, 50))],
-                          fill=color, width=random.randint(1, 5))
-        elif shape_type == 'focused':
+            for j in range(5):
+                _draw_line(pixels, x, y, x + line_offsets[i, j, 0], y + line_offsets[i, j, 1],
+                           line_widths[i, j], color)
+        elif kind == SHAPE_FOCUSED:
             # Concentric circles
-            for i in range(3):
-                draw.ellipse([x - i * 10, y - i * 10, x + size + i * 10, y + size + i * 10],
-                             outline=color, width=2)
-
-
-def apply_emotional_filters(image, emotional_cues):
+            for j in range(3):
+                _stroke_ellipse(pixels, x - j * 10, y - j * 10, x + size + j * 10, y + size + j * 10, 2, color)
+
+
+@njit(cache=True, nogil=True)
+def _clipped_bounds(pixels, x0, y0, x1, y1):
+    """Clip an inclusive bounding box to the buffer, returning half-open ranges"""
+    height, width = pixels.shape[0], pixels.shape[1]
+    return max(0, y0), min(height, y1 + 1), max(0, x0), min(width, x1 + 1)
+
+
+@njit(cache=True, nogil=True)
+def _fill_rectangle(pixels, x0, y0, x1, y1, color):
+    top, bottom, left, right = _clipped_bounds(pixels, x0, y0, x1, y1)
+    for py in range(top, bottom):
+        for px in range(left, right):
+            pixels[py, px] = color
+
+
+@njit(cache=True, nogil=True)
+def _ellipse_distance(px, py, cx, cy, rx, ry):
+    """Normalized distance of a pixel from an ellipse centre (1.0 on the edge)"""
+    dx = (px - cx) / rx
+    dy = (py - cy) / ry
+    return dx * dx + dy * dy
+
+
+@njit(cache=True, nogil=True)
+def _fill_ellipse(pixels, x0, y0, x1, y1, color):
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    rx, ry = max((x1 - x0) / 2, 0.5), max((y1 - y0) / 2, 0.5)
+    top, bottom, left, right = _clipped_bounds(pixels, x0, y0, x1, y1)
+    for py in range(top, bottom):
+        for px in range(left, right):
+            if _ellipse_distance(px, py, cx, cy, rx, ry) <= 1.0:
+                pixels[py, px] = color
+
+
+@njit(cache=True, nogil=True)
+def _stroke_ellipse(pixels, x0, y0, x1, y1, line_width, color):
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    rx, ry = max((x1 - x0) / 2, 0.5), max((y1 - y0) / 2, 0.5)
+    inner_rx, inner_ry = max(rx - line_width, 0.5), max(ry - line_width, 0.5)
+    top, bottom, left, right = _clipped_bounds(pixels, x0, y0, x1, y1)
+    for py in range(top, bottom):
+        for px in range(left, right):
+            if (_ellipse_distance(px, py, cx, cy, rx, ry) <= 1.0 and
+                    _ellipse_distance(px, py, cx, cy, inner_rx, inner_ry) > 1.0):
+                pixels[py, px] = color
+
+
+@njit(cache=True, nogil=True)
+def _fill_triangle(pixels, ax, ay, bx, by, cx, cy, color):
+    top, bottom, left, right = _clipped_bounds(pixels, min(ax, bx, cx), min(ay, by, cy),
+                                               max(ax, bx, cx), max(ay, by, cy))
+    area = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+    if area == 0:
+        return
+    for py in range(top, bottom):
+        for px in range(left, right):
+            # Same-side test against each edge, valid for either winding order
+            w0 = ((bx - ax) * (py - ay) - (by - ay) * (px - ax)) * area
+            w1 = ((cx - bx) * (py - by) - (cy - by) * (px - bx)) * area
+            w2 = ((ax - cx) * (py - cy) - (ay - cy) * (px - cx)) * area
+            if w0 >= 0 and w1 >= 0 and w2 >= 0:
+                pixels[py, px] = color
+
+
+@njit(cache=True, nogil=True)
+def _draw_line(pixels, x0, y0, x1, y1, line_width, color):
+    half = line_width / 2
+    pad = int(half) + 1
+    top, bottom, left, right = _clipped_bounds(pixels, min(x0, x1) - pad, min(y0, y1) - pad,
+                                               max(x0, x1) + pad, max(y0, y1) + pad)
+    dx, dy = x1 - x0, y1 - y0
+    length_sq = dx * dx + dy * dy
+    for py in range(top, bottom):
+        for px in range(left, right):
+            # Distance from the pixel to the closest point on the segment
+            t = 0.0
+            if length_sq > 0:
+                t = min(1.0, max(0.0, ((px - x0) * dx + (py - y0) * dy) / length_sq))
+            ex = px - (x0 + t * dx)
+            ey = py - (y0 + t * dy)
+            if ex * ex + ey * ey <= half * half:
+                pixels[py, px] = color
+
+
+# PIL's ImageFilter.SMOOTH kernel, applied with OpenCV's SIMD convolution
+SMOOTH_KERNEL = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32) / 13
+
+
+def apply_emotional_filters(pixels, switches):
     """Apply filters based on emotional intensity"""
-    if emotional_cues['chaotic'] > 0.4:
-        image = image.filter(ImageFilter.GaussianBlur(radius=1))
-    if emotional_cues['calm'] > 0.6:
-        image = image.filter(ImageFilter.SMOOTH)
+    if switches['blur']:
+        pixels = cv2.GaussianBlur(pixels, (0, 0), sigmaX=1.0)
+    if switches['smooth']:
+        pixels = cv2.filter2D(pixels, -1, SMOOTH_KERNEL)
+    return pixels
 
 
 def generate_fallback_image():
     """Generate a fallback abstract image"""
     width, height = 400, 400
-    image = Image.new('RGB', (width, height), (30, 30, 50))
-    draw = ImageDraw.Draw(image)
-
-    # Draw some default shapes
-    for _ in range(20):
-        x = random.randint(0, width)
-        y = random.randint(0, height)
-        size = random.randint(20, 80)
-        color = (random.randint(100, 200), random.randint(100, 200), random.randint(100, 200), 150)
-
-        if random.choice([True, False]):
-            draw.ellipse([x, y, x + size, y + size], fill=color)
-        else:
-            draw.rectangle([x, y, x + size, y + size], fill=color)
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    pixels[:] = (30, 30, 50)
+
+    # Draw some default shapes, with all random values drawn in one go
+    num_shapes = 20
+    kinds = _rng.integers(SHAPE_CIRCLE, SHAPE_RECTANGLE, num_shapes, endpoint=True)
+    xs = _rng.integers(0, width, num_shapes, endpoint=True)
+    ys = _rng.integers(0, height, num_shapes, endpoint=True)
+    sizes = _rng.integers(20, 80, num_shapes, endpoint=True)
+    colors = _rng.integers(100, 200, (num_shapes, 3), endpoint=True).astype(np.uint8)
+    no_lines = np.zeros((num_shapes, 5, 2), dtype=np.int64)
+
+    render_shapes(pixels, kinds, xs, ys, sizes, colors, no_lines, no_lines[:, :, 0])
+    image = Image.fromarray(pixels, 'RGB')
 
-    # Convert to base64
+    return encode_png(image)
+
+
+def encode_png(image):
+    """Encode an image as a base64 PNG data URL"""
+    # Fast zlib setting: these are throwaway decorative images, and compression
+    # dominates encode time at the default level
     buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
+    image.save(buffered, format="PNG", compress_level=1)
+    img_str = binascii.b2a_base64(buffered.getbuffer(), newline=False).decode('ascii')
 
     return f"data:image/png;base64,{img_str}"
 
 
+# Fallback images are purely decorative, so render a few once and reuse them. The pool is
+# built on a render thread at startup, which also warms the Numba kernels, so neither import
+# nor the event loop waits on the compile; coroutines must fetch it through IMG_POOL too
+@functools.lru_cache(maxsize=None)
+def fallback_pool():
+    return [generate_fallback_image() for _ in range(8)]
+
+
+IMG_POOL.submit(fallback_pool)
+
+
 # This is needed for Vercel serverless functions
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    import uvicorn
+    uvicorn.run("app:asgi_app", port=5000, reload=True)
\ No newline at end of file
@@ -0,0 +1,13 @@
+# Production server settings, picked up automatically by `gunicorn app:asgi_app`
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# Uvicorn workers run the ASGI app on an event loop, so each worker multiplexes many
+# in-flight Gemini calls instead of blocking a thread per request
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.environ.get('WEB_CONCURRENCY', '4'))
+
+# Gemini replies can take several seconds; leave headroom over the 30s client timeout
+timeout = 60
+keepalive = 5
\ No newline at end of file